@@ -1,14 +1,111 @@
+import os
+import functools
 import torch
 import random
+import re
+import array
+import multiprocessing
+import itertools
+import operator
+import numpy as np
 from tqdm import tqdm
-import torch.utils.data as data
-from transformers import GPT2Tokenizer, BertTokenizer
 from collections import defaultdict
+import torch.nn.functional as F
+import torch.utils.data as data
+from torch.utils.data.dataloader import default_collate
+from torch.nn.utils.rnn import pad_sequence
+from transformers import AddedToken, GPT2TokenizerFast, BertTokenizerFast
+
+
+SECTION_IDS = [
+    '[ TITLE ]',
+    '[ METHOD ]',
+    '[ STEP ]'
+]
+CL_EOS_STR = " . "
+
+
+@functools.lru_cache(maxsize=2)
+def _get_tokenizer(tokenizer_name):
+    """Loads the fast tokenizer once per process, with the section tokens added.
+
+    Train and test datasets (and forked DataLoader workers) share the instance.
+    """
+    if tokenizer_name == "GPT2":
+        tokenizer = GPT2TokenizerFast.from_pretrained('gpt2')
+        tokenizer.pad_token = tokenizer.eos_token
+    elif tokenizer_name == "BERT":
+        tokenizer = BertTokenizerFast.from_pretrained('bert-base-cased')
+    else:
+        raise ValueError("Dont recognize name {}".format(tokenizer_name))
+    # The slow tokenizers strip whitespace around plain-string added tokens;
+    # fast ones keep it unless asked, which would change e.g. "[ TITLE ] How"
+    # from "How" to "ĠHow" and no longer match the pretrained checkpoints.
+    tokenizer.add_tokens([AddedToken(token, lstrip=True, rstrip=True)
+                          for token in SECTION_IDS + [CL_EOS_STR]])
+    return tokenizer
+
+
+# Dataset being loaded; read by forked _process_data workers, which inherit it
+# (and its all_dataset) instead of receiving it pickled.
+_FORKED_DATASET = None
+
+
+def _process_forked_doc(doc_id):
+    return _FORKED_DATASET._process_doc(doc_id)
+
+
+def _tpk_indices(index, k, doc_id, sentence_id, total_doc_sentences, doc_start_idx):
+    """Returns the t, t+k, t-1, t-2, t-3 sentence indices and t/T for WikihowTPK."""
+    if k == 1:
+        if doc_id[index] != doc_id[index+1]:
+            index -= 1
+        i_t = index
+        i_tp1 = index + 1
+        t_frac = sentence_id[index] / total_doc_sentences[index]
+    else:
+        # k sampling
+        sid = sentence_id[index]
+        total_doc = total_doc_sentences[index]
+        tp1 = min(total_doc - 1, sid + k)
+        t = max(0, tp1 - k)
+        i_t = index + (t - sid)
+        i_tp1 = index + (tp1 - sid)
+        t_frac = t / total_doc
+    # Context from before the start of the document falls back to the sentence at index.
+    start = doc_start_idx[doc_id[index]]
+    i_tm1 = index - 1 if index - 1 >= start else index
+    i_tm2 = index - 2 if index - 2 >= start else index
+    i_tm3 = index - 3 if index - 3 >= start else index
+    return i_t, i_tp1, i_tm1, i_tm2, i_tm3, t_frac
+
+
+class _ProcessedDataView(object):
+    """Read-only list-of-dicts view over the columnar WikihowDataset storage."""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset.sentences)
+
+    def __getitem__(self, index):
+        return {
+            "sentence": self.dataset.sentences[index],
+            "sentence_id": int(self.dataset.sentence_id[index]),
+            "doc_id": int(self.dataset.doc_id[index]),
+            "total_doc_sentences": int(self.dataset.total_doc_sentences[index]),
+        }
 
 
 class WikihowDataset(data.Dataset):
     """WikiSection data"""
 
+    _SPLIT_RE = re.compile(r"\.  ")
+    # Empty sentences left over from splitting.
+    _SKIP = frozenset(('', ' . '))
+    # Methods with a sentence this long (in tokens) are dropped.
+    _MAX_TOKENS = 1024
 
     def __init__(
             self,
@@ -21,6 +118,7 @@ class WikihowDataset(data.Dataset):
         """
         """
         super().__init__()
+        self.one_hot_labels = False
         self.train = train
         self.all_dataset = all_dataset
         self.config=config
@@ -36,110 +134,188 @@ class WikihowDataset(data.Dataset):
         self._process_data()
         print("Done loading dataset.")
 
-    def _process_data(self):
-        self.processed_data = []
-        split_pattern = ".  "
-        doc_counter = 0
-        for doc_id in tqdm(range(self.start_idx, self.end_idx)):
-            doc = self.all_dataset[doc_id]
-
-            method2steps = defaultdict(list)
-            # Wikihow has k different methods
-            for _, v in doc['steps'].items():
-                # section = one of the how-to methods
-                method2steps[v['section']].append(v)
-
-            for method_name, steps in method2steps.items():
-                doc_info = []
-                sentence_counter = 0
-                # Put all the document sentences together.
-                all_sentences = [self.section_ids[0] + " " + doc['title'] + " . "]
-                all_sentences += [self.section_ids[1] + " " + method_name + " . "]
-                for step_num, step in enumerate(steps):
-                    directions = [ f"{self.section_ids[2]} {step_num} "
-                        + step['summary'][:-1] + " . "]
-                    sentences = [_ + " . " for _ in step['text'].split(split_pattern)]
-                    if sentences[-1].endswith(". . "):
-                        sentences[-1] = sentences[-1].replace('. . ', ' . ')
-                    all_sentences += directions + sentences
-
-                if not all([
-                        len(self.tokenizer(s)['input_ids']) < 1024 for s in all_sentences]):
+    def _process_doc(self, doc_id):
+        """Returns (sentences, input_ids) for every kept method of a document."""
+        doc = self.all_dataset[doc_id]
+        methods = []
+        # Wikihow has k different methods; section = one of the how-to
+        # methods. Steps are normally stored method by method, so a single
+        # groupby pass splits them.
+        steps = list(doc['steps'].values())
+        method2steps = [(method_name, list(group)) for method_name, group in
+                        itertools.groupby(steps, key=operator.itemgetter('section'))]
+        if len(method2steps) != len({method_name for method_name, _ in method2steps}):
+            # A method shows up again later in the document; group by name.
+            grouped = defaultdict(list)
+            for step in steps:
+                grouped[step['section']].append(step)
+            method2steps = grouped.items()
+        for method_name, steps in method2steps:
+            # Put all the document sentences together.
+            all_sentences = [
+                f"{self.section_ids[0]} {doc['title']} . ",
+                f"{self.section_ids[1]} {method_name} . ",
+            ]
+            append, extend = all_sentences.append, all_sentences.extend
+            for step_num, step in enumerate(steps):
+                # Directions, then the step's sentences.
+                append(f"{self.section_ids[2]} {step_num} {step['summary'][:-1]} . ")
+                raw = step['text']
+                extend(_ + " . " for _ in self._SPLIT_RE.split(raw))
+                if raw.endswith('.'):
+                    # The last sentence kept its period and now ends in '. . '.
+                    all_sentences[-1] = all_sentences[-1][:-4] + " . "
+
+            # One batched call instead of tokenizing sentence by sentence.
+            # The ids are kept so __getitem__ never has to re-tokenize.
+            enc = self.tokenizer(all_sentences)
+            if max(map(len, enc['input_ids'])) >= self._MAX_TOKENS:
+                continue
+
+            sentences, input_ids = [], []
+            for sentence, ids in zip(all_sentences, enc['input_ids']):
+                if sentence in self._SKIP:
                     continue
+                sentences.append(sentence)
+                input_ids.append(ids)
+            methods.append((sentences, input_ids))
+        return methods
+
+    def _map_docs(self, doc_ids, chunksize=8):
+        """Yields _process_doc(doc_id) in order, spread over forked worker processes."""
+        global _FORKED_DATASET
+        try:
+            # Respect CPU affinity / cgroup allocations (e.g. SLURM jobs).
+            num_cpus = len(os.sched_getaffinity(0))
+        except AttributeError:  # not available on macOS
+            num_cpus = os.cpu_count() or 1
+        num_workers = min(num_cpus, len(doc_ids) // chunksize)
+        if num_workers < 2 or 'fork' not in multiprocessing.get_all_start_methods():
+            yield from map(self._process_doc, doc_ids)
+            return
+        # The tokenizer already ran in this process; without this each child
+        # warns that huggingface/tokenizers was forked. The pool is the
+        # parallelism here, so the children tokenize serially.
+        parallelism = os.environ.get("TOKENIZERS_PARALLELISM")
+        os.environ["TOKENIZERS_PARALLELISM"] = "false"
+        _FORKED_DATASET = self
+        try:
+            with multiprocessing.get_context('fork').Pool(num_workers) as pool:
+                yield from pool.imap(_process_forked_doc, doc_ids, chunksize=chunksize)
+        finally:
+            _FORKED_DATASET = None
+            if parallelism is None:
+                del os.environ["TOKENIZERS_PARALLELISM"]
+            else:
+                os.environ["TOKENIZERS_PARALLELISM"] = parallelism
 
-                for sentence in all_sentences:
-                    if not sentence:
-                        continue
-                    if sentence == ' . ':
-                        continue
-                    sentence_info = {
-                        "sentence": sentence,
-                        "sentence_id": sentence_counter,
-                        "doc_id": doc_counter
-                    }
-                    doc_info.append(sentence_info)
-                    sentence_counter += 1
-
-                # Track total number of sentences in a document
-                for info in doc_info:
-                    info['total_doc_sentences'] = sentence_counter
-
-                self.processed_data += doc_info
-                doc_counter += 1
+    def _process_data(self):
+        # Stored as parallel columns rather than one dict per sentence.
+        self.sentences = []
+        token_ids = array.array('i')
+        self._sentence2index = {}
+        doc_range = range(self.start_idx, self.end_idx)
+        # Each method is its own document; ids are assigned serially here.
+        methods = [method
+                   for doc in tqdm(self._map_docs(doc_range), total=len(doc_range))
+                   for method in doc]
+        num_sentences = sum(len(sentences) for sentences, _ in methods)
+        # Sizes are known up front, so fill preallocated columns with a cursor.
+        self.sentence_id = np.empty(num_sentences, dtype=np.int32)
+        self.doc_id = np.empty(num_sentences, dtype=np.int32)
+        self.total_doc_sentences = np.empty(num_sentences, dtype=np.int32)
+        # Token ids of sentence i are token_ids[offsets[i]:offsets[i+1]].
+        self.offsets = np.zeros(num_sentences + 1, dtype=np.int64)
+        cursor = 0
+        for doc_counter, (sentences, input_ids) in enumerate(methods):
+            sentence_counter = len(sentences)
+            end = cursor + sentence_counter
+            for sentence_i, sentence in enumerate(sentences):
+                self._sentence2index.setdefault(sentence, cursor + sentence_i)
+            self.sentences.extend(sentences)
+            for ids in input_ids:
+                token_ids.extend(ids)
+            self.offsets[cursor+1:end+1] = [len(ids) for ids in input_ids]
+            self.sentence_id[cursor:end] = np.arange(sentence_counter)
+            self.doc_id[cursor:end] = doc_counter
+            # Track total number of sentences in a document
+            self.total_doc_sentences[cursor:end] = sentence_counter
+            cursor = end
+        np.cumsum(self.offsets, out=self.offsets)
+        # One flat array instead of a tensor object per sentence.
+        self._token_ids = np.frombuffer(token_ids, dtype=np.intc).astype(np.int32)
+        # Index of the first sentence of every document (doc_id is sorted).
+        self.doc_start_idx = np.searchsorted(self.doc_id, np.arange(len(methods)))
 
         print("Example: ", self.processed_data[0])
         print("Example: ", self.processed_data[10])
 
+    @classmethod
+    def recommended_loader_kwargs(cls):
+        """DataLoader kwargs suited to this dataset.
+
+        persistent_workers keeps the workers (and their fork of the loaded
+        dataset) alive across epochs instead of re-forking them every epoch;
+        samples are cheap index lookups, so a prefetch_factor of 2 is enough.
+        """
+        return dict(
+            num_workers=min(8, os.cpu_count() or 1),
+            persistent_workers=True,
+            prefetch_factor=2,
+            pin_memory=torch.cuda.is_available(),
+        )
+
+    @property
+    def processed_data(self):
+        return _ProcessedDataView(self)
+
     def _set_tokenizer(self):
+        self.tokenizer = _get_tokenizer(self.tokenizer_name)
         if self.tokenizer_name == "GPT2":
-            self.tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
-            self.tokenizer.pad_token = self.tokenizer.eos_token
             self.end_token = self.tokenizer.eos_token_id
             self.max_length = 1024
         elif self.tokenizer_name == "BERT":
-            self.tokenizer = BertTokenizer.from_pretrained('bert-base-cased')
             self.max_length = 512
-        else:
-            raise ValueError("Dont recognize name {}".format(self.tokenizer_name))
 
-        self.section_ids = [
-            '[ TITLE ]',
-            '[ METHOD ]',
-            '[ STEP ]'
-        ]
+        self.section_ids = SECTION_IDS
         self.section_names = self.section_ids
-        self.cl_eos_str = " . "
-        self.tokenizer.add_tokens(self.section_ids + [self.cl_eos_str])
-        self.special_tokens = [_[0] for _ in self.tokenizer(self.section_ids)['input_ids']]
-        self.cl_eos_id = self.tokenizer(self.cl_eos_str)['input_ids'][0]
+        self.cl_eos_str = CL_EOS_STR
+        special_ids = self.tokenizer(self.section_ids + [self.cl_eos_str])['input_ids']
+        self.special_tokens = [_[0] for _ in special_ids[:-1]]
+        self.cl_eos_id = special_ids[-1][0]
+
 
+    def _get_cached_ids(self, sentence):
+        """Returns the cached input_ids of `sentence`, or None if it was not seen in _process_data."""
+        index = self._sentence2index.get(sentence)
+        if index is None:
+            return None
+        return torch.from_numpy(self._token_ids[self.offsets[index]:self.offsets[index+1]])
 
     def tokenize_caption(self, caption, device):
+        if isinstance(caption, str):
+            caption = [caption]
+        input_ids = [self._get_cached_ids(s) for s in caption]
+        # Sentences outside the cache (e.g. test sentences passed to the
+        # train dataset) are tokenized together in one batched call.
+        misses = [i for i, ids in enumerate(input_ids) if ids is None]
+        if misses:
+            output = self.tokenizer([caption[i] for i in misses])
+            for i, ids in zip(misses, output['input_ids']):
+                input_ids[i] = torch.tensor(ids, dtype=torch.int32)
+        # Unpadded masks are all ones.
+        attention_mask = [torch.ones_like(ids) for ids in input_ids]
+        input_ids = pad_sequence(
+            input_ids, batch_first=True, padding_value=self.tokenizer.pad_token_id)
+        attention_mask = pad_sequence(attention_mask, batch_first=True, padding_value=0)
         if self.tokenizer_name == "GPT2":
-            output = self.tokenizer(
-                caption,
-                padding=True,
-                return_tensors='pt',
-            )
-            input_ids = output['input_ids'].squeeze(0)
-            attention_mask = output['attention_mask'].squeeze(0)
-            eos_input_ids = torch.tensor([[self.end_token]*input_ids.shape[0]])
-            eos_attention = torch.tensor([[0]*input_ids.shape[0]])
-            input_ids = torch.cat((input_ids, eos_input_ids.T), dim=1)
-            attention_mask = torch.cat((attention_mask, eos_attention.T), dim=1)
-        elif self.tokenizer_name == "BERT":
-            # Prepend [CLS] so I can use the first embedding
-            output = self.tokenizer(
-                caption,
-                padding=True,
-                return_tensors='pt',
-            )
-            input_ids = output['input_ids'].squeeze(0)
-            attention_mask = output['attention_mask'].squeeze(0)
-        return input_ids.to(device), attention_mask.to(device)
+            # Append the (unattended) EOS column.
+            input_ids = F.pad(input_ids, (0, 1), value=self.end_token)
+            attention_mask = F.pad(attention_mask, (0, 1), value=0)
+        return input_ids.long().to(device), attention_mask.long().to(device)
 
     def __len__(self):
-        return len(self.processed_data) - 1
+        return len(self.sentences) - 1
 
 class WikihowDiscourse(WikihowDataset):
     def __init__(
@@ -149,9 +325,12 @@ class WikihowDiscourse(WikihowDataset):
             config,
             tokenizer_name="GPT2",
             seed=1,
+            filepath=None,
+            one_hot_labels=False,
     ):
         """
         """
+        del filepath  # Wikihow reads from all_dataset
         super(WikihowDiscourse, self).__init__(
             train=train,
             all_dataset=all_dataset,
@@ -159,22 +338,32 @@ class WikihowDiscourse(WikihowDataset):
             tokenizer_name=tokenizer_name,
             seed=seed,
         )
+        # Offsets from every index to its t / t+k sentence, computed once.
+        k = self.config.data_params.k
+        tp1 = np.minimum(self.total_doc_sentences - 1, self.sentence_id + k)
+        t = np.maximum(0, tp1 - k)
+        self._t_off = (t - self.sentence_id).astype(np.int32)
+        self._tp1_off = (tp1 - self.sentence_id).astype(np.int32)
+        self.one_hot_labels = one_hot_labels
+
+    def collate_fn(self, batch):
+        # Labels stay ints per sample and are one-hot encoded once per batch.
+        batch = default_collate(batch)
+        if self.one_hot_labels:
+            batch['label'] = F.one_hot(batch['label'], num_classes=2).float()
+        return batch
 
     def __getitem__(self, index):
         label = random.randint(0, 1) # either in- or out-of-order
 
         # SETUP 4: sample t+k utterance
-        utterance = self.processed_data[index]
-        tp1 = min(utterance['total_doc_sentences']-1, utterance['sentence_id']+self.config.data_params.k)
-        t = max(0, tp1-self.config.data_params.k)
-
-        y_t = self.processed_data[index + (t - utterance['sentence_id'])]
-        y_tp1 = self.processed_data[index + (tp1 - utterance['sentence_id'])]
+        t_index = index + int(self._t_off[index])
+        tp1_index = index + int(self._tp1_off[index])
 
-        assert y_t['doc_id'] == y_tp1['doc_id']
+        assert self.doc_id[t_index] == self.doc_id[tp1_index]
 
-        y_t = y_t['sentence']
-        y_tp1 = y_tp1['sentence']
+        y_t = self.sentences[t_index]
+        y_tp1 = self.sentences[tp1_index]
 
         if label:
             pass # do nothing
@@ -183,18 +372,13 @@ class WikihowDiscourse(WikihowDataset):
             y_tp1 = y_t
             y_t = tmp
 
-        if self.one_hot_labels:
-            labels = torch.zeros(2)
-            labels[label] = 1.0
-            label = labels
-
         result = {
             'y_t': y_t,
             'y_tp1': y_tp1,
             'label': label,
             'idx': index,
-            't': index + (t - utterance['sentence_id']),
-            'tp1': index + (tp1 - utterance['sentence_id']),
+            't': t_index,
+            'tp1': tp1_index,
         }
 
         return result
@@ -219,10 +403,21 @@ class WikihowTriplet(WikihowDataset):
             seed=seed,
         )
         self.k = self.config.data_params.k
+        self._rng_seed = self.seed
+        self._rng = np.random.default_rng(self._rng_seed)
+
+    def _get_rng(self):
+        # Re-seed inside each DataLoader worker (and epoch); otherwise every
+        # forked worker would replay the same copy of the generator.
+        worker_info = data.get_worker_info()
+        seed = self.seed if worker_info is None else worker_info.seed
+        if seed != self._rng_seed:
+            self._rng_seed = seed
+            self._rng = np.random.default_rng(seed)
+        return self._rng
 
     def __getitem__(self, index):
-        utterance = self.processed_data[index]
-        sentence_num = utterance['sentence_id']
+        sentence_num = self.sentence_id[index]
 
         # Check if index is start of a seq. If so -> +2
         if sentence_num == 0:
@@ -231,30 +426,22 @@ class WikihowTriplet(WikihowDataset):
             index += 1
 
         # Update
-        utterance = self.processed_data[index]
-        sentence_num = utterance['sentence_id']
+        sentence_num = int(self.sentence_id[index])
 
         # TRIAL 2: Sample all random points, t, t', t''
         T = sentence_num
         # t is a random point in between
-        nums = list(range(T))
-        t1 = random.choice(nums)
-        nums.remove(t1)
-        t2 = random.choice(nums)
-        if t2 < t1:
-            t = t2
-            t2 = t1
-            t1 = t
+        t1, t2 = sorted(self._get_rng().choice(T, 2, replace=False).tolist())
 
         assert t1 < t2 and t2 < T
-        y_0 = self.processed_data[index - T + t1]['sentence']
-        y_t = self.processed_data[index - T + t2]['sentence']
-        y_T = self.processed_data[index]['sentence']
+        y_0 = self.sentences[index - T + t1]
+        y_t = self.sentences[index - T + t2]
+        y_T = self.sentences[index]
 
         t_ = t1
         t = t2
 
-        total_doc = utterance['total_doc_sentences']
+        total_doc = int(self.total_doc_sentences[index])
         result = {
             'y_0': y_0,
             'y_t': y_t,
@@ -288,33 +475,18 @@ class WikihowTPK(WikihowDataset):
             seed=seed,
         )
 
-    def __getitem__(self, index):
-        k = self.config.data_params.k
-        if k == 1:
-            if self.processed_data[index]['doc_id'] != self.processed_data[index+1]['doc_id']:
-                index -= 1
-
-            y_t = self.processed_data[index]['sentence']
-            y_tp1 = self.processed_data[index+1]['sentence']
-            t = self.processed_data[index]['sentence_id']/self.processed_data[index]['total_doc_sentences']
-        else:
-            # k sampling
-            utterance = self.processed_data[index]
-            tp1 = min(utterance['total_doc_sentences']-1,
-                      utterance['sentence_id']+self.config.data_params.k)
-            t = max(0, tp1-self.config.data_params.k)
-
-            y_t = self.processed_data[index + (t - utterance['sentence_id'])]['sentence']
-            y_tp1 = self.processed_data[index + (tp1 - utterance['sentence_id'])]['sentence']
-            t = self.processed_data[index + (t - utterance['sentence_id'])]['sentence_id']/utterance['total_doc_sentences']
-
-        y_tm1 = (self.processed_data[index] if (index - 1 < 0 or self.processed_data[index]['doc_id'] != self.processed_data[index-1]['doc_id']) else self.processed_data[index-1])
-        y_tm1 = y_tm1['sentence']
-        y_tm2 = (self.processed_data[index] if (index - 2 < 0 or self.processed_data[index]['doc_id'] != self.processed_data[index-2]['doc_id']) else self.processed_data[index-2])
-        y_tm2 = y_tm2['sentence']
-        y_tm3 = (self.processed_data[index] if (index - 3 < 0 or self.processed_data[index]['doc_id'] != self.processed_data[index-3]['doc_id']) else self.processed_data[index-3])
-        y_tm3 = y_tm3['sentence']
+    def _get_indices(self, index):
+        return _tpk_indices(
+            index, self.config.data_params.k, self.doc_id, self.sentence_id,
+            self.total_doc_sentences, self.doc_start_idx)
 
+    def __getitem__(self, index):
+        i_t, i_tp1, i_tm1, i_tm2, i_tm3, t = self._get_indices(index)
+        y_t = self.sentences[i_t]
+        y_tp1 = self.sentences[i_tp1]
+        y_tm1 = self.sentences[i_tm1]
+        y_tm2 = self.sentences[i_tm2]
+        y_tm3 = self.sentences[i_tm3]
 
         result = {
             'y_t': y_t,
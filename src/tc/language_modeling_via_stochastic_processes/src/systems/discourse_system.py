@@ -52,6 +52,7 @@ def create_dataloader(dataset, config, shuffle=True):
         pin_memory=True,
         drop_last=shuffle,
         num_workers=config.experiment_params.data_loader_workers,
+        collate_fn=getattr(dataset, 'collate_fn', None),
     )
     return loader
 